@@ -1,16 +1,185 @@
+import asyncio
 import json
+import logging
 import os
-import time
-from datetime import datetime
-from typing import Dict, Optional
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 REGION_NAME = os.getenv("AWS_REGION_NAME") or "us-east-1"
-S3_BUCKET_NAME: str = os.environ["S3_BUCKET_NAME"]
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Environment variables the provisioner needs."""
+
+    vpc_id: str
+    db_instance_identifier: str
+    db_name: str
+    db_username: str
+    db_password: str = field(repr=False)
+    s3_bucket_name: str
+
+
+@lru_cache(maxsize=None)
+def _get_settings() -> Settings:
+    """
+    Read the environment on first use, so importing this module does not require it.
+
+    A missing variable raises KeyError from the first provisioning call instead of at import.
+    """
+    return Settings(
+        vpc_id=os.environ["DEFAULT_VPC_ID"],
+        db_instance_identifier=os.environ["DB_INSTANCE_IDENTIFIER"],
+        db_name=os.environ["RDS_DB_NAME"],
+        db_username=os.environ["RDS_USERNAME"],
+        db_password=os.environ["RDS_PASSWORD"],
+        s3_bucket_name=os.environ["S3_BUCKET_NAME"],
+    )
+
+
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+# Keep-alive lets consecutive calls (and the RDS waiter polls) reuse the open HTTPS connection.
+# botocore builds its socket options from urllib3's defaults, which already set TCP_NODELAY.
+# Since botocore 1.27.84 (boto3 1.24.84, the pinned minimum) it also adds SO_KEEPALIVE when
+# Config(tcp_keepalive=True) is set; older releases only read tcp_keepalive from the AWS config
+# file. No socket patching is needed either way.
+# The default pool of 10 connections per client would serialize callers that run several
+# provisioners concurrently (e.g. a batch provisioner sharing these clients), so it is raised.
+BOTO_CONFIG = Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    # Adaptive mode adds client-side rate limiting on top of exponential backoff with jitter,
+    # so throttled calls back off instead of retrying in lockstep.
+    retries={"mode": "adaptive", "max_attempts": 10},
+    connect_timeout=5,
+    read_timeout=30,
+)
+# Skip botocore's client-side validation of the deeply nested DistributionConfig. Only its
+# static structure (the constants below) is trusted: the origin id, domain name, TargetOriginId
+# and the OAI comment come from S3_BUCKET_NAME, so a bad value is now rejected by CloudFront
+# as a server-side error instead of by botocore before the request is sent.
+CLOUDFRONT_CONFIG = BOTO_CONFIG.merge(Config(parameter_validation=False))
+
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/example-bucket-policies.html
+# Let the CloudFront Origin Access Identity (first %s) read objects from the bucket (second %s).
+BUCKET_POLICY_TEMPLATE = (
+    '{"Version":"2008-10-17","Statement":[{"Sid":"1","Effect":"Allow",'
+    '"Principal":{"AWS":"arn:aws:iam::cloudfront:user/CloudFront Origin Access Identity %s"},'
+    '"Action":"s3:GetObject","Resource":"arn:aws:s3:::%s/*"}]}'
+)
+
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.authorize_security_group_ingress
+# Every rule of a direction goes into one authorize call; add new rules to these lists
+# rather than issuing another call per rule.
+SECURITY_GROUP_EGRESS_RULES = [
+    {
+        "FromPort": 0,
+        "IpProtocol": "-1",
+        "IpRanges": [],
+        "Ipv6Ranges": [
+            {"CidrIpv6": "::/0", "Description": "allow all (demo only)"},
+        ],
+        "PrefixListIds": [],
+        "ToPort": 0,
+    },
+]
+SECURITY_GROUP_INGRESS_RULES = [
+    {
+        "FromPort": 0,
+        "IpProtocol": "-1",
+        "IpRanges": [
+            {"CidrIp": "0.0.0.0/0", "Description": "allow all (demo only)"},
+        ],
+        "Ipv6Ranges": [
+            {"CidrIpv6": "::/0", "Description": "allow all (demo only)"},
+        ],
+        "PrefixListIds": [],
+        "ToPort": 0,
+    },
+]
+
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#CloudFront.Client.create_distribution
+# The parts of DistributionConfig that do not depend on the bucket or the Origin Access Identity.
+# They are built once and shared between calls; botocore only reads request parameters.
+DEFAULT_CACHE_BEHAVIOR_DEFAULTS = {
+    "Compress": True,
+    "ViewerProtocolPolicy": "allow-all",
+    "AllowedMethods": {
+        "Quantity": 3,
+        "Items": ["GET", "HEAD", "OPTIONS"],
+        "CachedMethods": {
+            "Quantity": 2,
+            "Items": ["GET", "HEAD"],
+        },
+    },
+    "ForwardedValues": {
+        "QueryString": False,
+        "Cookies": {
+            "Forward": "none",
+        },
+    },
+    "MinTTL": 0,
+    "DefaultTTL": 3600,
+    "MaxTTL": 86400,
+}
+DISTRIBUTION_CONFIG_DEFAULTS = {
+    "Restrictions": {"GeoRestriction": {"RestrictionType": "none", "Quantity": 0}},
+    "ViewerCertificate": {
+        "CloudFrontDefaultCertificate": True,
+    },
+    "Enabled": True,
+    "IsIPV6Enabled": True,
+    "DefaultRootObject": "index.html",
+    "Comment": "Django React static distribution",
+}
+
+
+# Building sessions and clients is not thread-safe, so the first build of each one happens under
+# this lock; cache hits skip it. Reentrant because _get_client builds its session while holding it.
+_FACTORY_LOCK = threading.RLock()
+_SESSIONS: Dict[Optional[str], boto3.Session] = {}
+_CLIENTS: Dict[Tuple[str, Optional[str], Config], Any] = {}
+
+
+def _get_session(region_name: Optional[str] = None) -> boto3.Session:
+    """Return one session per region, so its clients share a single credential resolution."""
+    session = _SESSIONS.get(region_name)
+    if session is None:
+        with _FACTORY_LOCK:
+            session = _SESSIONS.get(region_name)
+            if session is None:
+                session = _SESSIONS[region_name] = boto3.Session(region_name=region_name)
+    return session
+
+
+def _get_client(service_name: str, region_name: Optional[str] = None, config: Config = BOTO_CONFIG) -> Any:
+    """
+    Return a client cached per service and region, so warm Lambda invocations reuse it.
+
+    Service models are loaded here, on first use, rather than when the module is imported.
+    Safe to call from several threads at once.
+    """
+    key = (service_name, region_name, config)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _FACTORY_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = _CLIENTS[key] = _get_session(region_name).client(service_name, config=config)
+    return client
 
 
 def create_aws_resource_for_django_on_lambda(region_name: Optional[str] = "us-east-1") -> Dict[str, str]:
@@ -23,6 +192,12 @@ def create_aws_resource_for_django_on_lambda(region_name: Optional[str] = "us-ea
     - S3 bucket Policy
     - CloudFront Distribution
 
+    Independent AWS calls are issued concurrently in stages, each stage waiting only
+    for the results the next one depends on.
+
+    The result is stored in SSM Parameter Store under `/provisioner/<S3_BUCKET_NAME>`;
+    when that parameter already exists it is returned without creating anything.
+
     :returns Dict with results like this
     {
         "db_host_name": "django-aws-postgres.bavmorkee3lr.us-east-1.rds.amazonaws.com",
@@ -30,203 +205,204 @@ def create_aws_resource_for_django_on_lambda(region_name: Optional[str] = "us-ea
     }
 
     """
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#vpc
-    ec2_resource = boto3.resource("ec2")
-
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#securitygroup
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.ServiceResource.create_security_group
-    security_group = ec2_resource.create_security_group(
-        Description="sg-for-lambdas",
-        GroupName="django-rds-security-group",
-        VpcId=os.environ["DEFAULT_VPC_ID"],
-        TagSpecifications=[
-            {
-                "ResourceType": "security-group",
-                "Tags": [
-                    {"Key": "Name", "Value": "django-demo-rds-security-group"},
-                ],
-            },
-        ],
-        DryRun=False,
-    )
+    settings = _get_settings()
+    bucket_name = settings.s3_bucket_name
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.SecurityGroup.authorize_egress
-    _ = security_group.authorize_egress(
-        DryRun=False,
-        IpPermissions=[
-            {
-                "FromPort": 0,
-                "IpProtocol": "-1",
-                "IpRanges": [],
-                "Ipv6Ranges": [
-                    {"CidrIpv6": "::/0", "Description": "allow all (demo only)"},
-                ],
-                "PrefixListIds": [],
-                "ToPort": 0,
-            },
-        ],
-        TagSpecifications=[
-            {
-                "ResourceType": "security-group-rule",
-                "Tags": [
-                    {"Key": "Name", "Value": "egress rule"},
-                ],
-            },
-        ],
-    )
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ssm.html#SSM.Client.get_parameter
+    ssm_client = _get_client("ssm", region_name)
+    parameter_name = f"/provisioner/{bucket_name}"
+    try:
+        parameter = ssm_client.get_parameter(Name=parameter_name)
+    except ssm_client.exceptions.ParameterNotFound:
+        pass
+    else:
+        return json.loads(parameter["Parameter"]["Value"])
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.SecurityGroup.authorize_ingress
-    _ = security_group.authorize_ingress(
-        DryRun=False,
-        IpPermissions=[
-            {
-                "FromPort": 0,
-                "IpProtocol": "-1",
-                "IpRanges": [
-                    {"CidrIp": "0.0.0.0/0", "Description": "allow all (demo only)"},
-                ],
-                "Ipv6Ranges": [
-                    {"CidrIpv6": "::/0", "Description": "allow all (demo only)"},
-                ],
-                "PrefixListIds": [],
-                "ToPort": 0,
-            },
-        ],
-        TagSpecifications=[
-            {
-                "ResourceType": "security-group-rule",
-                "Tags": [
-                    {"Key": "Name", "Value": "ingress rule"},
-                ],
+    caller_reference = secrets.token_hex(16)
+
+    # Clients are fetched up front and shared with the pool threads; client method calls are thread-safe.
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#client
+    ec2_client = _get_client("ec2", region_name)
+    rds_client = _get_client("rds", region_name)
+    s3_client = _get_client("s3", region_name)
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#id93
+    cloudfront_client = _get_client("cloudfront", region_name, CLOUDFRONT_CONFIG)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # Stage 1: SecurityGroup, S3 bucket and CloudFront Origin Access Identity do not depend on each other.
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.create_security_group
+        security_group_future = executor.submit(
+            ec2_client.create_security_group,
+            Description="sg-for-lambdas",
+            GroupName="django-rds-security-group",
+            VpcId=settings.vpc_id,
+            TagSpecifications=[
+                {
+                    "ResourceType": "security-group",
+                    "Tags": [
+                        {"Key": "Name", "Value": "django-demo-rds-security-group"},
+                    ],
+                },
+            ],
+            DryRun=False,
+        )
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.create_bucket
+        bucket_future = executor.submit(
+            s3_client.create_bucket,
+            ACL="private",
+            Bucket=bucket_name,
+        )
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#CloudFront.Client.create_cloud_front_origin_access_identity
+        origin_access_identity_future = executor.submit(
+            cloudfront_client.create_cloud_front_origin_access_identity,
+            CloudFrontOriginAccessIdentityConfig={
+                "CallerReference": caller_reference,
+                "Comment": f'access-identity-{bucket_name}.s3.amazonaws.com"',
             },
-        ],
-    )
+        )
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds.html#RDS.Client.create_db_instance
-    rds_client = boto3.client("rds", region_name=region_name)
-    _ = rds_client.create_db_instance(
-        DBName=os.environ["RDS_DB_NAME"],
-        DBInstanceIdentifier=os.environ["DB_INSTANCE_IDENTIFIER"],
-        AllocatedStorage=20,
-        DBInstanceClass="db.t2.micro",
-        Engine="postgres",
-        EngineVersion="12.5",
-        MasterUsername=os.environ["RDS_USERNAME"],
-        MasterUserPassword=os.environ["RDS_PASSWORD"],
-        VpcSecurityGroupIds=[security_group.id],
-        Tags=[{"Key": "name", "Value": "django_demo_rds"}],
-    )
+        security_group_id = security_group_future.result()["GroupId"]
+        _ = bucket_future.result()
+        response = origin_access_identity_future.result()
+        origin_access_identity_id = response["CloudFrontOriginAccessIdentity"]["Id"]
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.create_bucket
-    s3_client = boto3.client("s3", region_name=region_name)
-    _ = s3_client.create_bucket(
-        ACL="private",
-        Bucket=S3_BUCKET_NAME,
-    )
+        # Stage 2: everything that needs the SecurityGroup id, the bucket or the Origin Access Identity id.
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#id93
-    cloudfront_client = boto3.client("cloudfront", region_name=region_name)
-
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#CloudFront.Client.create_cloud_front_origin_access_identity
-    response = cloudfront_client.create_cloud_front_origin_access_identity(
-        CloudFrontOriginAccessIdentityConfig={
-            "CallerReference": str(datetime.utcnow().timestamp()),
-            "Comment": f'access-identity-{S3_BUCKET_NAME}.s3.amazonaws.com"',
-        }
-    )
-    origin_access_identity_id = response["CloudFrontOriginAccessIdentity"]["Id"]
-
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#bucketpolicy
-    s3_resource = boto3.resource("s3")
-    bucket_policy = s3_resource.BucketPolicy(S3_BUCKET_NAME)
-    _ = bucket_policy.put(
-        Policy=json.dumps(
-            {
-                "Version": "2008-10-17",
-                "Statement": [
-                    {
-                        "Sid": "1",
-                        "Effect": "Allow",
-                        "Principal": {
-                            "AWS": f"arn:aws:iam::cloudfront:user/CloudFront "
-                            f"Origin Access Identity {origin_access_identity_id}",
-                        },
-                        "Action": "s3:GetObject",
-                        "Resource": f"arn:aws:s3:::{S3_BUCKET_NAME}/*",
-                    }
-                ],
-            }
-        ),
-    )
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.authorize_security_group_egress
+        egress_future = executor.submit(
+            ec2_client.authorize_security_group_egress,
+            GroupId=security_group_id,
+            DryRun=False,
+            IpPermissions=SECURITY_GROUP_EGRESS_RULES,
+            TagSpecifications=[
+                {
+                    "ResourceType": "security-group-rule",
+                    "Tags": [
+                        {"Key": "Name", "Value": "egress rule"},
+                    ],
+                },
+            ],
+        )
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.authorize_security_group_ingress
+        ingress_future = executor.submit(
+            ec2_client.authorize_security_group_ingress,
+            GroupId=security_group_id,
+            DryRun=False,
+            IpPermissions=SECURITY_GROUP_INGRESS_RULES,
+            TagSpecifications=[
+                {
+                    "ResourceType": "security-group-rule",
+                    "Tags": [
+                        {"Key": "Name", "Value": "ingress rule"},
+                    ],
+                },
+            ],
+        )
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds.html#RDS.Client.create_db_instance
+        db_instance_future = executor.submit(
+            rds_client.create_db_instance,
+            DBName=settings.db_name,
+            DBInstanceIdentifier=settings.db_instance_identifier,
+            AllocatedStorage=20,
+            DBInstanceClass="db.t2.micro",
+            Engine="postgres",
+            EngineVersion="12.5",
+            MasterUsername=settings.db_username,
+            MasterUserPassword=settings.db_password,
+            VpcSecurityGroupIds=[security_group_id],
+            Tags=[{"Key": "name", "Value": "django_demo_rds"}],
+        )
 
-    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#CloudFront.Client.create_distribution
-    cloudfront_distribution_response = cloudfront_client.create_distribution(
-        DistributionConfig={
-            "CallerReference": str(datetime.utcnow().timestamp()),
-            "Origins": {
-                "Quantity": 1,
-                "Items": [
-                    {
-                        "Id": S3_BUCKET_NAME,
-                        "DomainName": f"{S3_BUCKET_NAME}.s3.amazonaws.com",
-                        "S3OriginConfig": {
-                            "OriginAccessIdentity": f"origin-access-identity/cloudfront/{origin_access_identity_id}"
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.put_bucket_policy
+        bucket_policy_future = executor.submit(
+            s3_client.put_bucket_policy,
+            Bucket=bucket_name,
+            Policy=BUCKET_POLICY_TEMPLATE % (origin_access_identity_id, bucket_name),
+        )
+
+        # The distribution only needs the Origin Access Identity id, so it does not wait for the bucket policy.
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/cloudfront.html#CloudFront.Client.create_distribution
+        # CloudFront uses the rest-xml protocol, so botocore serializes DistributionConfig to XML, not JSON.
+        distribution_future = executor.submit(
+            cloudfront_client.create_distribution,
+            DistributionConfig={
+                **DISTRIBUTION_CONFIG_DEFAULTS,
+                "CallerReference": caller_reference,
+                "Origins": {
+                    "Quantity": 1,
+                    "Items": [
+                        {
+                            "Id": bucket_name,
+                            "DomainName": f"{bucket_name}.s3.amazonaws.com",
+                            "S3OriginConfig": {
+                                "OriginAccessIdentity": f"origin-access-identity/cloudfront/{origin_access_identity_id}"
+                            },
                         },
-                    },
-                ],
-            },
-            "Restrictions": {"GeoRestriction": {"RestrictionType": "none", "Quantity": 0}},
-            "ViewerCertificate": {
-                "CloudFrontDefaultCertificate": True,
-            },
-            "DefaultCacheBehavior": {
-                "TargetOriginId": S3_BUCKET_NAME,
-                "Compress": True,
-                "ViewerProtocolPolicy": "allow-all",
-                "AllowedMethods": {
-                    "Quantity": 3,
-                    "Items": ["GET", "HEAD", "OPTIONS"],
-                    "CachedMethods": {
-                        "Quantity": 2,
-                        "Items": ["GET", "HEAD"],
-                    },
+                    ],
                 },
-                "ForwardedValues": {
-                    "QueryString": False,
-                    "Cookies": {
-                        "Forward": "none",
-                    },
+                "DefaultCacheBehavior": {
+                    **DEFAULT_CACHE_BEHAVIOR_DEFAULTS,
+                    "TargetOriginId": bucket_name,
                 },
-                "MinTTL": 0,
-                "DefaultTTL": 3600,
-                "MaxTTL": 86400,
             },
-            "Enabled": True,
-            "IsIPV6Enabled": True,
-            "DefaultRootObject": "index.html",
-            "Comment": "Django React static distribution",
-        }
-    )
-
-    while True:
-        rds_db_instances = rds_client.describe_db_instances(
-            DBInstanceIdentifier="string",
-            Filters=[
-                {"Name": "db-instance-id", "Values": [os.environ["DB_INSTANCE_IDENTIFIER"]]},
-            ],
-            MaxRecords=20,
         )
 
-        if rds_db_instances["DBInstances"][0].get("Endpoint"):
-            db_host_name = rds_db_instances["DBInstances"][0]["Endpoint"]["Address"]
-            break
-        time.sleep(100)
+        _ = egress_future.result()
+        _ = ingress_future.result()
+        _ = db_instance_future.result()
+        _ = bucket_policy_future.result()
+        cloudfront_distribution_response = distribution_future.result()
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds.html#RDS.Waiter.DBInstanceAvailable
+    waiter = rds_client.get_waiter("db_instance_available")
+    waiter.wait(
+        DBInstanceIdentifier=settings.db_instance_identifier,
+        WaiterConfig={"Delay": 15, "MaxAttempts": 40},
+    )
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rds.html#RDS.Client.describe_db_instances
+    rds_db_instances = rds_client.describe_db_instances(
+        DBInstanceIdentifier=settings.db_instance_identifier,
+    )
+    db_host_name = rds_db_instances["DBInstances"][0]["Endpoint"]["Address"]
 
-    return {
+    result = {
         "db_host_name": db_host_name,
         "cloudfront_domain_name": cloudfront_distribution_response["Distribution"]["DomainName"],
     }
 
+    # Everything exists at this point, so a failed cache write must not hide the result from the caller.
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ssm.html#SSM.Client.put_parameter
+    try:
+        _ = ssm_client.put_parameter(
+            Name=parameter_name,
+            Value=json.dumps(result),
+            Type="String",
+            Overwrite=True,
+        )
+    except (BotoCoreError, ClientError):
+        logger.warning("Could not store the provisioning result in SSM parameter %s", parameter_name, exc_info=True)
+
+    return result
+
+
+async def acreate_aws_resource_for_django_on_lambda(region_name: Optional[str] = "us-east-1") -> Dict[str, str]:
+    """
+    Async variant of `create_aws_resource_for_django_on_lambda` for async Lambda handlers or ASGI apps.
+
+    The provisioning runs in the default executor, so the event loop keeps serving other tasks
+    while the AWS calls and the RDS waiter block. Concurrent calls are supported: the shared
+    clients are built once under a lock by `_get_client`, even when several calls start on a
+    cold process.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, create_aws_resource_for_django_on_lambda, region_name)
+
 
 if __name__ == "__main__":
     result = create_aws_resource_for_django_on_lambda(REGION_NAME)